@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+コンパクトログ ベンチマークスクリプト
+
+JSONFormatterとCompactLogHandlerが実際に書き出すレコードあたりのバイト数と
+エンコード時間を比較する
+"""
+
+import io
+import json
+import logging
+import random
+import timeit
+from datetime import datetime, timedelta
+from healthmate_core.environment import JSONFormatter
+from healthmate_core.environment.compact_log import CompactLogEncoder, CompactLogHandler
+
+
+RECORD_COUNT = 10000
+SERVICE = "healthmate-core"
+ENVIRONMENT = "prod"
+
+
+def make_records():
+    """ベンチマーク用のログレコード"""
+    loggers = ["healthmate.api", "healthmate.auth", "healthmate.db"]
+    levels = [logging.INFO, logging.WARNING, logging.ERROR]
+    records = []
+    for i in range(RECORD_COUNT):
+        record = logging.LogRecord(
+            loggers[i % 3], levels[i % 3], __file__, 0,
+            "request %d completed for user %s", (i, f"user-{i % 97}"), None
+        )
+        record.request_id = f"req-{i:08d}"
+        records.append(record)
+    return records
+
+
+def make_timestamps():
+    """0〜20ミリ秒間隔で進むタイムスタンプ"""
+    rng = random.Random(0)
+    timestamp = datetime(2026, 1, 1)
+    timestamps = []
+    for _ in range(RECORD_COUNT):
+        timestamp += timedelta(microseconds=rng.randrange(20000))
+        timestamps.append(timestamp)
+    return timestamps
+
+
+class ReplayHandler(CompactLogHandler):
+    """事前に用意したタイムスタンプを使用するハンドラー"""
+
+    def __init__(self, stream, timestamps, **kwargs):
+        self._timestamps = iter(timestamps)
+        super().__init__(stream, SERVICE, ENVIRONMENT, **kwargs)
+
+    def _now(self):
+        return next(self._timestamps)
+
+
+def handler_bytes(records, timestamps, compress):
+    """CompactLogHandlerが書き出すバイト数"""
+    stream = io.BytesIO()
+    handler = ReplayHandler(stream, timestamps, compress=compress, flush_interval=3600)
+    for record in records:
+        handler.handle(record)
+    handler.close()
+    return len(stream.getvalue())
+
+
+def benchmark_compact_log():
+    """JSONとコンパクトエンコーディングの比較"""
+    print("=== Compact Log Benchmark ===\n")
+    formatter = JSONFormatter(SERVICE, ENVIRONMENT)
+    records = make_records()
+    timestamps = make_timestamps()
+    fields = [formatter.log_fields(record) for record in records]
+
+    def encode_json():
+        # JSONFormatter.format()と同じ処理
+        return [
+            json.dumps({'timestamp': timestamp.isoformat() + 'Z', **entry}, ensure_ascii=False)
+            for timestamp, entry in zip(timestamps, fields)
+        ]
+
+    def encode_compact():
+        encoder = CompactLogEncoder()
+        return [encoder.header()] + [
+            encoder.encode(timestamp, entry) for timestamp, entry in zip(timestamps, fields)
+        ]
+
+    json_size = len("\n".join(encode_json()).encode("utf-8")) + RECORD_COUNT
+    compact_size = handler_bytes(records, timestamps, compress=False)
+    compressed_size = handler_bytes(records, timestamps, compress=True)
+
+    print(f"レコード数: {RECORD_COUNT}（1/3がERROR：圧縮時はERRORごとにブロックを書き出す）")
+    print(f"JSON:              {json_size / RECORD_COUNT:7.1f} bytes/record")
+    print(f"compact:           {compact_size / RECORD_COUNT:7.1f} bytes/record "
+          f"({json_size / compact_size:.1f}x)")
+    print(f"compact + zlib:    {compressed_size / RECORD_COUNT:7.1f} bytes/record "
+          f"({json_size / compressed_size:.1f}x)")
+
+    json_time = min(timeit.repeat(encode_json, number=1, repeat=5))
+    compact_time = min(timeit.repeat(encode_compact, number=1, repeat=5))
+    print(f"\nJSON エンコード:    {json_time / RECORD_COUNT * 1e6:6.2f} us/record")
+    print(f"compact エンコード: {compact_time / RECORD_COUNT * 1e6:6.2f} us/record")
+
+    print("\n=== ベンチマーク完了 ===")
+
+
+if __name__ == "__main__":
+    benchmark_compact_log()
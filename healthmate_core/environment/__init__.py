@@ -12,7 +12,15 @@ from .environment_manager import (
     handle_environment_error
 )
 from .configuration_provider import ConfigurationProvider
-from .log_controller import LogController, JSONFormatter, LoggingError, safe_logging_setup
+from .log_controller import (
+    LogController,
+    JSONFormatter,
+    Span,
+    TraceContext,
+    LoggingError,
+    parse_trace_header,
+    safe_logging_setup
+)
 from .environment_config import EnvironmentConfig
 
 __all__ = [
@@ -21,11 +29,14 @@ __all__ = [
     'LogController',
     'EnvironmentConfig',
     'JSONFormatter',
+    'Span',
+    'TraceContext',
     'EnvironmentError',
     'InvalidEnvironmentError',
     'ConfigurationError',
     'LoggingError',
     'handle_environment_error',
+    'parse_trace_header',
     'safe_logging_setup'
 ]
 
@@ -0,0 +1,523 @@
+"""
+Compact Log - コンパクトなバイナリログエンコーディング
+
+JSONFormatterの出力をキー辞書・タイムスタンプ差分・ブロック圧縮で
+小さなバイナリレコードに変換し、ストリーミングでJSON行に復元するシステム
+
+ストリーム形式:
+    各フレームは「タグ(1バイト) + 長さ(varint) + ペイロード」で構成される
+    - ヘッダー: マジック "HMLC" + バージョン + フラグ（ストリームの先頭、常に非圧縮）
+    - 文字列定義: UTF-8文字列（出現順にIDを割り当てる）
+    - レコード: タイムスタンプ差分(マイクロ秒) + フィールド数 + (キーID, 値)の並び
+    - 圧縮ブロック: 圧縮フラグが立っている場合、文字列定義・レコードフレームは
+      ブロック単位でzlib圧縮（Z_SYNC_FLUSH）され、このフレームに格納される
+    ライターが異常終了してフレームが途中で途切れた場合でも、デコーダーは次のヘッダーフレームを
+    探索して再同期するため、後から追記されたストリームは復元できる（途切れたストリームの
+    残りのレコードは失われる）
+"""
+
+import json
+import logging
+import struct
+import sys
+import threading
+import zlib
+from datetime import datetime, timedelta
+from typing import Any, BinaryIO, Dict, Iterator, List
+from .log_controller import JSONFormatter, LoggingError
+
+
+MAGIC = b"HMLC"
+VERSION = 1
+FLAG_COMPRESSED = 0x01
+
+# フレームタグ
+TAG_HEADER = 0x00
+TAG_STRING = 0x01
+TAG_RECORD = 0x02
+TAG_BLOCK = 0x03
+
+# ヘッダーフレームの先頭（タグ + 長さ + マジック）。再同期時の探索に使用する
+HEADER_SIGNATURE = bytes((TAG_HEADER, len(MAGIC) + 2)) + MAGIC
+
+# 値タグ
+VALUE_NULL = 0x00
+VALUE_TRUE = 0x01
+VALUE_FALSE = 0x02
+VALUE_INT = 0x03
+VALUE_FLOAT = 0x04
+VALUE_STR = 0x05
+VALUE_REF = 0x06
+VALUE_JSON = 0x07
+
+# 値を文字列辞書に登録するキー（ストリーム内で繰り返し出現する、種類が限られた値）
+INTERNED_VALUE_KEYS = frozenset(['level', 'service', 'environment', 'logger'])
+
+DEFAULT_BLOCK_SIZE = 64 * 1024
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+_EPOCH = datetime(1970, 1, 1)
+_ONE_MICROSECOND = timedelta(microseconds=1)
+_DOUBLE = struct.Struct("<d")
+_SMALL_VARINTS = [bytes((n,)) for n in range(0x80)]
+
+
+def _varint(n: int) -> bytes:
+    """非負整数のLEB128エンコード"""
+    if n < 0x80:
+        return _SMALL_VARINTS[n]
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _zigzag(n: int) -> int:
+    return n << 1 if n >= 0 else ((-n) << 1) - 1
+
+
+def _unzigzag(n: int) -> int:
+    return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+
+def _read_varint(data, pos: int):
+    """LEB128のデコード（データ不足の場合は位置にNoneを返す）"""
+    result = 0
+    shift = 0
+    end = len(data)
+    while pos < end:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+    return 0, None
+
+
+class CompactLogEncoder:
+    """ログエントリのコンパクトエンコーダー（ストリーム単位で状態を持つ）"""
+
+    def __init__(self, compress: bool = False):
+        self.compress = compress
+        self._string_refs: Dict[str, bytes] = {}
+        self._last_timestamp_us = 0
+
+    def header(self) -> bytes:
+        """ストリームヘッダーフレーム"""
+        payload = MAGIC + bytes((VERSION, FLAG_COMPRESSED if self.compress else 0))
+        return bytes((TAG_HEADER,)) + _varint(len(payload)) + payload
+
+    def encode(self, timestamp: datetime, fields: Dict[str, Any]) -> bytes:
+        """ログエントリのエンコード
+
+        Args:
+            timestamp: ログのタイムスタンプ（UTC）
+            fields: JSONFormatter.log_fields()と同じ順序のフィールド
+
+        Returns:
+            文字列定義フレーム（新出文字列がある場合）とレコードフレーム
+        """
+        timestamp_us = (timestamp - _EPOCH) // _ONE_MICROSECOND
+        definitions = bytearray()
+        body = bytearray(_varint(_zigzag(timestamp_us - self._last_timestamp_us)))
+        body += _varint(len(fields))
+        self._last_timestamp_us = timestamp_us
+
+        refs = self._string_refs
+        for key, value in fields.items():
+            ref = refs.get(key)
+            if ref is None:
+                ref = self._define(key, definitions)
+            body += ref
+
+            if value.__class__ is str:
+                if key in INTERNED_VALUE_KEYS:
+                    ref = refs.get(value)
+                    if ref is None:
+                        ref = self._define(value, definitions)
+                    body.append(VALUE_REF)
+                    body += ref
+                else:
+                    encoded = value.encode('utf-8')
+                    body.append(VALUE_STR)
+                    body += _varint(len(encoded))
+                    body += encoded
+            elif value is None:
+                body.append(VALUE_NULL)
+            elif value is True:
+                body.append(VALUE_TRUE)
+            elif value is False:
+                body.append(VALUE_FALSE)
+            elif value.__class__ is int:
+                body.append(VALUE_INT)
+                body += _varint(_zigzag(value))
+            elif value.__class__ is float:
+                body.append(VALUE_FLOAT)
+                body += _DOUBLE.pack(value)
+            else:
+                # その他の型はJSON断片として保持し、復元時にそのまま埋め込む
+                encoded = json.dumps(value, ensure_ascii=False).encode('utf-8')
+                body.append(VALUE_JSON)
+                body += _varint(len(encoded))
+                body += encoded
+
+        definitions.append(TAG_RECORD)
+        definitions += _varint(len(body))
+        definitions += body
+        return bytes(definitions)
+
+    def _define(self, value: str, out: bytearray) -> bytes:
+        """文字列辞書への登録（定義フレームをoutに追加し、参照を返す）"""
+        encoded = value.encode('utf-8')
+        out.append(TAG_STRING)
+        out += _varint(len(encoded))
+        out += encoded
+        ref = _varint(len(self._string_refs))
+        self._string_refs[value] = ref
+        return ref
+
+
+class CompactLogDecoder:
+    """コンパクトログのストリーミングデコーダー
+
+    任意の区切りで受け取ったバイト列からJSON行（JSONFormatterと同一の出力）を復元する
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._block_buffer = bytearray()
+        self._decompressor = None
+        self._started = False
+        self._error = None
+        self.skipped_bytes = 0
+        self._reset_stream()
+
+    def _reset_stream(self):
+        """新しいストリームの開始（辞書とタイムスタンプを初期化）"""
+        self._fragments: List[str] = []
+        self._last_timestamp_us = 0
+        self._block_buffer.clear()
+
+    def feed(self, data: bytes) -> List[str]:
+        """バイト列を追加し、完成したJSON行を返す
+
+        破損・途切れたフレームは次のヘッダーフレームまで読み飛ばす（skipped_bytesに計上）。
+        末尾がヘッダーの先頭とも読めるフレームは、後続のバイトまたはclose()まで保留される
+        """
+        lines: List[str] = []
+        self._buffer += data
+        consumed = self._parse_frames(self._buffer, lines, outer=True)
+        del self._buffer[:consumed]
+        return lines
+
+    def close(self) -> List[str]:
+        """入力の終端（保留中のJSON行を返す。未完了のフレームや再同期できなかった破損があればエラー）"""
+        lines: List[str] = []
+        consumed = self._parse_frames(self._buffer, lines, outer=True, final=True)
+        del self._buffer[:consumed]
+        if self._error is not None:
+            raise LoggingError(f"Corrupted compact log stream: {self._error}")
+        if self._buffer or self._block_buffer:
+            raise LoggingError("Truncated compact log stream")
+        return lines
+
+    def _parse_frames(self, buffer: bytearray, lines: List[str], outer: bool, final: bool = False) -> int:
+        """完成したフレームを処理し、消費したバイト数を返す"""
+        pos = 0
+        end = len(buffer)
+        if outer and self._error is not None:
+            pos = self._resync(buffer, 0, 0)
+            if self._error is not None:
+                return pos
+        while pos < end:
+            tag = buffer[pos]
+            length, start = _read_varint(buffer, pos + 1)
+            complete = start is not None and start + length <= end
+            if outer and tag != TAG_HEADER:
+                # 途切れたフレームの長さが後続ストリームのヘッダーにかかっている場合
+                frame_end = start + length if complete else end
+                search_end = min(end, frame_end + len(HEADER_SIGNATURE) - 1)
+                signature = buffer.find(HEADER_SIGNATURE, pos + 1, search_end)
+                if signature != -1:
+                    self._discard(signature - pos)
+                    pos = signature
+                    continue
+                if complete and not final and _partial_signature(buffer, pos + 1, frame_end):
+                    # ヘッダーの先頭とも読めるため、後続のバイトを待って判定する
+                    break
+            if not complete:
+                break
+            payload = bytes(buffer[start:start + length])
+
+            try:
+                self._process_frame(tag, payload, lines, outer)
+            except LoggingError as e:
+                if not outer:
+                    raise
+                self._error = e
+                self._started = False
+                pos = self._resync(buffer, pos, pos + 1)
+                if self._error is not None:
+                    return pos
+                continue
+            pos = start + length
+        return pos
+
+    def _process_frame(self, tag: int, payload: bytes, lines: List[str], outer: bool):
+        if tag == TAG_HEADER and outer:
+            self._start_stream(payload)
+        elif not self._started:
+            raise LoggingError("Compact log stream does not start with a header")
+        elif tag == TAG_BLOCK and outer:
+            self._decode_block(payload, lines)
+        elif tag == TAG_RECORD and (self._decompressor is None) == outer:
+            lines.append(self._decode_record(payload))
+        elif tag == TAG_STRING and (self._decompressor is None) == outer:
+            try:
+                self._fragments.append(json.dumps(payload.decode('utf-8'), ensure_ascii=False))
+            except UnicodeDecodeError as e:
+                raise LoggingError(f"Corrupted compact log string: {e}")
+        else:
+            raise LoggingError(f"Unexpected compact log frame tag: {tag}")
+
+    def _resync(self, buffer: bytearray, pos: int, search_from: int) -> int:
+        """pos以降を読み飛ばし、次のヘッダーフレームの位置を返す
+
+        見つからない場合はヘッダーの一部になり得る末尾を残し、エラー状態を継続する
+        """
+        signature = buffer.find(HEADER_SIGNATURE, search_from)
+        if signature == -1:
+            signature = max(pos, len(buffer) - len(HEADER_SIGNATURE) + 1)
+        else:
+            self._error = None
+        self._discard(signature - pos)
+        return signature
+
+    def _discard(self, count: int):
+        self.skipped_bytes += count
+
+    def _start_stream(self, payload: bytes):
+        if len(payload) < 6 or payload[:4] != MAGIC:
+            raise LoggingError("Invalid compact log header")
+        if payload[4] != VERSION:
+            raise LoggingError(f"Unsupported compact log version: {payload[4]}")
+        # 直前のストリームの未完了データ（異常終了したライター等）は破棄する
+        self._reset_stream()
+        self._started = True
+        self._decompressor = zlib.decompressobj() if payload[5] & FLAG_COMPRESSED else None
+
+    def _decode_block(self, payload: bytes, lines: List[str]):
+        if self._decompressor is None:
+            raise LoggingError("Compressed block in uncompressed compact log stream")
+        try:
+            self._block_buffer += self._decompressor.decompress(payload)
+        except zlib.error as e:
+            raise LoggingError(f"Corrupted compact log block: {e}")
+        consumed = self._parse_frames(self._block_buffer, lines, outer=False)
+        del self._block_buffer[:consumed]
+
+    def _decode_record(self, payload: bytes) -> str:
+        try:
+            line, pos = self._decode_fields(payload)
+        except LoggingError:
+            raise
+        except (IndexError, TypeError, ValueError, struct.error, OverflowError) as e:
+            raise LoggingError(f"Corrupted compact log record: {e!r}")
+        if pos != len(payload):
+            raise LoggingError("Corrupted compact log record: trailing bytes")
+        return line
+
+    def _decode_fields(self, payload: bytes):
+        fragments = self._fragments
+        delta, pos = _read_varint(payload, 0)
+        self._last_timestamp_us += _unzigzag(delta)
+        timestamp = (_EPOCH + timedelta(microseconds=self._last_timestamp_us)).isoformat() + 'Z'
+        count, pos = _read_varint(payload, pos)
+
+        parts = ['"timestamp": "' + timestamp + '"']
+        for _ in range(count):
+            key_id, pos = _read_varint(payload, pos)
+            tag = payload[pos]
+            pos += 1
+            if tag == VALUE_REF:
+                value_id, pos = _read_varint(payload, pos)
+                value = fragments[value_id]
+            elif tag == VALUE_STR:
+                length, pos = _read_varint(payload, pos)
+                value = json.dumps(_slice(payload, pos, length).decode('utf-8'), ensure_ascii=False)
+                pos += length
+            elif tag == VALUE_NULL:
+                value = 'null'
+            elif tag == VALUE_TRUE:
+                value = 'true'
+            elif tag == VALUE_FALSE:
+                value = 'false'
+            elif tag == VALUE_INT:
+                raw, pos = _read_varint(payload, pos)
+                value = str(_unzigzag(raw))
+            elif tag == VALUE_FLOAT:
+                value = json.dumps(_DOUBLE.unpack_from(payload, pos)[0])
+                pos += _DOUBLE.size
+            elif tag == VALUE_JSON:
+                length, pos = _read_varint(payload, pos)
+                value = _slice(payload, pos, length).decode('utf-8')
+                pos += length
+            else:
+                raise LoggingError(f"Unknown compact log value tag: {tag}")
+            parts.append(fragments[key_id] + ': ' + value)
+        return '{' + ', '.join(parts) + '}', pos
+
+
+def _partial_signature(buffer: bytearray, start: int, frame_end: int) -> bool:
+    """フレーム末尾からバッファ終端までがヘッダーフレームの途中までと一致するか"""
+    end = len(buffer)
+    for pos in range(max(start, frame_end - len(HEADER_SIGNATURE) + 1), frame_end):
+        if end - pos < len(HEADER_SIGNATURE) and HEADER_SIGNATURE.startswith(bytes(buffer[pos:end])):
+            return True
+    return False
+
+
+def _slice(payload: bytes, pos: int, length: int) -> bytes:
+    """範囲外を許さないスライス"""
+    if pos + length > len(payload):
+        raise IndexError("value exceeds record length")
+    return payload[pos:pos + length]
+
+
+def decode_compact_log(stream: BinaryIO, chunk_size: int = DEFAULT_BLOCK_SIZE) -> Iterator[str]:
+    """バイナリストリームからJSON行を順次復元する"""
+    decoder = CompactLogDecoder()
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        yield from decoder.feed(chunk)
+    yield from decoder.close()
+
+
+class CompactLogHandler(logging.Handler):
+    """コンパクトエンコーディングでファイル・パイプへ出力するハンドラー
+
+    圧縮時はレコードをブロックにまとめて書き出す。ブロックはblock_sizeに達したとき、
+    ERROR以上のレコードを受け取ったとき、最初のレコードからflush_interval秒経過したときに
+    書き出されるため、プロセスが強制終了・凍結された場合に失われるのはその間のレコードに限られる
+
+    圧縮ブロックの書き込みに失敗した場合、圧縮状態と出力先の内容が一致しなくなるため、
+    エラーをhandleErrorで報告した上で以降の出力を停止する
+    """
+
+    def __init__(self, stream: BinaryIO, service_name: str, environment: str,
+                 compress: bool = False, block_size: int = DEFAULT_BLOCK_SIZE,
+                 flush_interval: float = DEFAULT_FLUSH_INTERVAL, close_stream: bool = False):
+        super().__init__()
+        self.stream = stream
+        self.close_stream = close_stream
+        self.block_size = block_size
+        self.flush_interval = flush_interval
+        self.broken = False
+        self._fields_formatter = JSONFormatter(service_name, environment)
+        self._encoder = CompactLogEncoder(compress)
+        self._compressor = zlib.compressobj() if compress else None
+        self._block = bytearray()
+        self._block_record = None
+        self._flush_timer = None
+        self.stream.write(self._encoder.header())
+        self.stream.flush()
+
+    def emit(self, record: logging.LogRecord):
+        if self.broken:
+            return
+        try:
+            data = self._encoder.encode(self._now(), self._fields_formatter.log_fields(record))
+            if self._compressor is None:
+                self.stream.write(data)
+                self.stream.flush()
+                return
+            self._block += data
+            if len(self._block) >= self.block_size or record.levelno >= logging.ERROR:
+                self._write_block()
+            elif self._flush_timer is None:
+                # タイマーでの書き出し失敗を報告するため、ブロック先頭のレコードを保持する
+                self._block_record = record
+                self._flush_timer = threading.Timer(self.flush_interval, self._flush_on_timer)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+        except Exception:
+            self.handleError(record)
+
+    def _now(self) -> datetime:
+        """レコードのタイムスタンプ（UTC）"""
+        return datetime.utcnow()
+
+    def _flush_on_timer(self):
+        """flush_interval経過時のブロック書き出し（エラーはhandleErrorで報告する）"""
+        self.acquire()
+        try:
+            self._flush_timer = None
+            record = self._block_record
+            if self.broken or not self._block:
+                return
+            try:
+                self._write_block()
+            except Exception:
+                self.handleError(record)
+        finally:
+            self.release()
+
+    def flush(self):
+        """バッファ中のブロックの書き出し"""
+        self.acquire()
+        try:
+            if self.broken:
+                return
+            if self._compressor is not None and self._block:
+                self._write_block()
+            if not self.stream.closed:
+                self.stream.flush()
+        finally:
+            self.release()
+
+    def close(self):
+        """バッファ中のブロックを書き出してクローズ（close_stream指定時はストリームもクローズ）"""
+        self.acquire()
+        try:
+            self._cancel_timer()
+            record = self._block_record
+            try:
+                self.flush()
+            except Exception:
+                self.handleError(record)
+            self._compressor = None
+            if self.close_stream:
+                self.stream.close()
+        finally:
+            self.release()
+            super().close()
+
+    def _cancel_timer(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
+    def _write_block(self):
+        self._cancel_timer()
+        data = self._compressor.compress(bytes(self._block)) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        self._block.clear()
+        self._block_record = None
+        try:
+            # フレームは1回のwriteで書き出し、途中で途切れたフレームを最小限にする
+            self.stream.write(bytes((TAG_BLOCK,)) + _varint(len(data)) + data)
+            self.stream.flush()
+        except Exception:
+            # 圧縮状態が出力先より先に進んでいるため、以降のブロックは復元できない
+            self.broken = True
+            raise
+
+
+if __name__ == "__main__":
+    # 標準入力のコンパクトログをJSON行として標準出力へ復元
+    for line in decode_compact_log(sys.stdin.buffer):
+        sys.stdout.write(line + "\n")
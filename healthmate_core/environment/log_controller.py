@@ -6,11 +6,25 @@ Log Controller - 環境別ログ制御
 
 import logging
 import json
+import os
+import random
+import functools
+import inspect
+import time
+from contextvars import ContextVar
 from datetime import datetime
-from typing import Dict, Any
+from time import perf_counter_ns
+from typing import Dict, Any, Optional, NamedTuple, Union, BinaryIO, TextIO
 from .environment_manager import EnvironmentManager
 
 
+# スパンを出力する専用ロガー名
+SPAN_LOGGER_NAME = "healthmate.span"
+
+# 現在のスパン（contextvarsによりスレッド・非同期タスク間で分離される）
+_current_span: ContextVar[Optional["Span"]] = ContextVar("healthmate_current_span", default=None)
+
+
 class LogController:
     """環境別ログ制御"""
     
@@ -20,11 +34,35 @@ class LogController:
         "prod": logging.WARNING
     }
     
-    def __init__(self, service_name: str):
+    # 環境別のスパンサンプリング率（HEALTHMATE_SPAN_SAMPLE_RATEで上書き可能）
+    SPAN_SAMPLE_RATES = {
+        "dev": 1.0,
+        "stage": 1.0,
+        "prod": 0.1
+    }
+    
+    def __init__(self, service_name: str, span_sample_rate: Optional[float] = None):
         self.service_name = service_name
         self.environment = EnvironmentManager.get_environment()
+        self.span_sample_rate = self._resolve_span_sample_rate(span_sample_rate)
+        self._span_logger = logging.getLogger(SPAN_LOGGER_NAME)
         self.setup_logging()
     
+    def _resolve_span_sample_rate(self, span_sample_rate: Optional[float]) -> float:
+        """スパンサンプリング率の決定（引数 > 環境変数 > 環境別デフォルト）"""
+        if span_sample_rate is None:
+            env_rate = os.environ.get("HEALTHMATE_SPAN_SAMPLE_RATE")
+            if env_rate is not None:
+                try:
+                    span_sample_rate = float(env_rate)
+                except ValueError:
+                    raise LoggingError(f"Invalid HEALTHMATE_SPAN_SAMPLE_RATE: {env_rate}")
+            else:
+                span_sample_rate = self.SPAN_SAMPLE_RATES.get(self.environment, 1.0)
+        if not 0.0 <= span_sample_rate <= 1.0:
+            raise LoggingError(f"Span sample rate must be between 0.0 and 1.0: {span_sample_rate}")
+        return span_sample_rate
+    
     def setup_logging(self):
         """ログ設定の初期化"""
         log_level = self.LOG_LEVELS.get(self.environment, logging.INFO)
@@ -38,8 +76,10 @@ class LogController:
             root_logger.removeHandler(handler)
         
         # 新しいハンドラーを追加
+        # スパンはサンプリングで量を制御するため、ログレベルに関わらず出力する
         handler = logging.StreamHandler()
-        handler.setLevel(log_level)
+        handler.addFilter(SpanAwareLevelFilter(log_level))
+        self._span_logger.setLevel(logging.INFO)
         
         if self.environment == "dev":
             # 開発環境：人間が読みやすい形式
@@ -63,6 +103,279 @@ class LogController:
             'environment': self.environment
         })
         return logger
+    
+    def add_sink(self, destination: Union[str, BinaryIO, TextIO], encoding: str = "json",
+                 compress: bool = False) -> logging.Handler:
+        """ファイル・パイプへの出力先の追加
+        
+        Args:
+            destination: ファイルパス、またはパイプ等のストリーム
+                （compactの場合はバイナリストリーム）
+            encoding: "json"（JSON行）または "compact"（バイナリ、compact_logで復元可能）
+            compress: compactエンコーディング時にブロック圧縮を行うか
+                （ブロックはERROR以上のレコードまたは1秒経過で書き出されるため、
+                強制終了時に失われ得るのは直近1秒以内のERROR未満のレコードのみ）
+            
+        Returns:
+            追加したハンドラー
+        """
+        if encoding == "json":
+            if isinstance(destination, str):
+                handler = logging.FileHandler(destination, encoding='utf-8')
+            else:
+                handler = logging.StreamHandler(destination)
+            handler.setFormatter(JSONFormatter(self.service_name, self.environment))
+        elif encoding == "compact":
+            from .compact_log import CompactLogHandler
+            if isinstance(destination, str):
+                handler = CompactLogHandler(open(destination, 'ab'), self.service_name, self.environment,
+                                            compress=compress, close_stream=True)
+            else:
+                handler = CompactLogHandler(destination, self.service_name, self.environment,
+                                            compress=compress)
+        else:
+            raise LoggingError(f"Unsupported log encoding: {encoding}")
+        
+        log_level = self.LOG_LEVELS.get(self.environment, logging.INFO)
+        handler.addFilter(SpanAwareLevelFilter(log_level))
+        logging.getLogger().addHandler(handler)
+        return handler
+    
+    def span(self, name: str, trace_header: Optional[str] = None) -> "Span":
+        """計測スパンの作成（with文で使用）
+        
+        Args:
+            name: スパン名
+            trace_header: 受信したtraceparentまたはX-Amzn-Trace-Idヘッダー
+                （解析できた場合は現在のスパンではなくヘッダーを親とする）
+            
+        Returns:
+            コンテキストマネージャーとして使用するスパン
+        """
+        # サンプリング率0はスパンの無効化（上流でサンプリング済みのトレースも含む）
+        if self.span_sample_rate <= 0.0:
+            return _NOOP_SPAN
+        
+        parent = None
+        if trace_header:
+            parent = parse_trace_header(trace_header)
+        if parent is None:
+            # ヘッダーが無い・解析できない場合は現在のスパンを親とする
+            parent = _current_span.get()
+        
+        if parent is None:
+            # ルートスパン
+            if self.span_sample_rate < 1.0 and random.random() >= self.span_sample_rate:
+                # 子スパンにも非サンプリングを伝播させるため、IDなしのスパンを設定する
+                return Span(name, None, None, None, False, self)
+            return Span(name, _new_trace_id(), _new_span_id(), None, True, self)
+        
+        if parent.sampled is None:
+            # 呼び出し元がサンプリングを決定していない場合はこちらで決定
+            sampled = random.random() < self.span_sample_rate
+        else:
+            sampled = parent.sampled
+        
+        if not sampled:
+            if isinstance(parent, Span):
+                # 非サンプリングの親スパンの内側ではコンテキストの切り替えも不要
+                return _NOOP_SPAN
+            # 下流への伝播用に受信したトレースIDを保持する
+            return Span(name, parent.trace_id, parent.span_id, parent.span_id, False, self)
+        
+        return Span(name, parent.trace_id, _new_span_id(), parent.span_id, True, self)
+    
+    def traced(self, name: Optional[str] = None):
+        """関数をスパンで計測するデコレータ
+        
+        ジェネレーター関数は反復の途中でスパンが呼び出し元のコンテキストに残るため対象外
+        （ジェネレーター内でspan()を使用する）
+        """
+        def decorator(func):
+            span_name = name or func.__qualname__
+            
+            if inspect.isgeneratorfunction(func) or inspect.isasyncgenfunction(func):
+                raise LoggingError(
+                    f"traced() does not support generator functions: {func.__qualname__}; "
+                    "use span() inside the generator instead"
+                )
+            
+            if inspect.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with self.span(span_name):
+                        return await func(*args, **kwargs)
+                return async_wrapper
+            
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(span_name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+    
+    @staticmethod
+    def current_span() -> Optional["Span"]:
+        """現在のスパンの取得"""
+        return _current_span.get()
+    
+    def _emit_span(self, span: "Span", error: Optional[str]):
+        """スパン終了ログの出力"""
+        span_fields = {
+            'span_name': span.name,
+            'trace_id': span.trace_id,
+            'span_id': span.span_id,
+            'parent_id': span.parent_id,
+            'duration_ms': round(span.duration_ns / 1_000_000, 3)
+        }
+        if error:
+            span_fields['error'] = error
+        self._span_logger.info(
+            f"span {span.name} finished in {span_fields['duration_ms']} ms",
+            extra={'span': span_fields}
+        )
+
+
+class TraceContext(NamedTuple):
+    """受信ヘッダーから復元したトレースコンテキスト"""
+    trace_id: str
+    span_id: Optional[str]
+    sampled: Optional[bool]
+
+
+class Span:
+    """計測スパン
+    
+    with文で使用し、終了時に所要時間を構造化ログとして出力する
+    """
+    
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'sampled',
+                 'start_ns', 'duration_ns', '_controller', '_token')
+    
+    def __init__(self, name: str, trace_id: Optional[str], span_id: Optional[str],
+                 parent_id: Optional[str], sampled: bool, controller: Optional[LogController]):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.start_ns = 0
+        self.duration_ns = 0
+        self._controller = controller
+        self._token = None
+    
+    def __enter__(self) -> "Span":
+        self._token = _current_span.set(self)
+        if self.sampled:
+            self.start_ns = perf_counter_ns()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        try:
+            if self.sampled:
+                self.duration_ns = perf_counter_ns() - self.start_ns
+                self._controller._emit_span(self, exc_type.__name__ if exc_type else None)
+        finally:
+            _current_span.reset(self._token)
+        return False
+    
+    def traceparent(self) -> Optional[str]:
+        """下流へ伝播するW3C traceparentヘッダー値"""
+        if not self.trace_id or not self.span_id:
+            return None
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+    
+    def xray_header(self) -> Optional[str]:
+        """下流へ伝播するX-Amzn-Trace-Idヘッダー値"""
+        if not self.trace_id or not self.span_id:
+            return None
+        return (f"Root=1-{self.trace_id[:8]}-{self.trace_id[8:]};"
+                f"Parent={self.span_id};Sampled={1 if self.sampled else 0}")
+
+
+class _NoopSpan(Span):
+    """非サンプリング時に使用する何もしないスパン"""
+    
+    __slots__ = ()
+    
+    def __enter__(self) -> "Span":
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        return False
+
+
+_NOOP_SPAN = _NoopSpan("noop", None, None, None, False, None)
+
+
+def _new_trace_id() -> str:
+    # 上位32ビットはエポック秒（X-Rayのトレースヘッダーとして有効な形式にするため）
+    return "%08x%024x" % (int(time.time()) & 0xFFFFFFFF, random.getrandbits(96))
+
+
+def _new_span_id() -> str:
+    return "%016x" % random.getrandbits(64)
+
+
+def parse_trace_header(header: str) -> Optional[TraceContext]:
+    """traceparentまたはX-Amzn-Trace-Idヘッダーの解析
+    
+    Args:
+        header: "00-<trace_id>-<parent_id>-<flags>" 形式、
+            または "Root=1-xxxxxxxx-xxxxxxxxxxxxxxxxxxxxxxxx;Parent=...;Sampled=1" 形式
+            
+    Returns:
+        トレースコンテキスト（解析できない場合はNone）
+    """
+    header = header.strip()
+    
+    if header.startswith("Root=") or ";" in header:
+        # X-Ray形式
+        fields = {}
+        for part in header.split(";"):
+            key, _, value = part.strip().partition("=")
+            fields[key] = value
+        root = fields.get("Root", "").split("-")
+        if len(root) != 3 or root[0] != "1":
+            return None
+        trace_id = (root[1] + root[2]).lower()
+        if len(trace_id) != 32 or not _is_hex(trace_id):
+            return None
+        span_id = fields.get("Parent", "").lower() or None
+        if span_id is not None and (len(span_id) != 16 or not _is_hex(span_id)):
+            return None
+        sampled = {"1": True, "0": False}.get(fields.get("Sampled"))
+        return TraceContext(trace_id, span_id, sampled)
+    
+    # W3C traceparent形式
+    parts = header.lower().split("-")
+    if len(parts) < 4 or len(parts[0]) != 2 or parts[0] == "ff":
+        return None
+    trace_id, span_id, flags = parts[1], parts[2], parts[3]
+    if (len(trace_id) != 32 or len(span_id) != 16 or len(flags) != 2
+            or not _is_hex(trace_id + span_id + flags)
+            or trace_id == "0" * 32 or span_id == "0" * 16):
+        return None
+    return TraceContext(trace_id, span_id, bool(int(flags, 16) & 0x01))
+
+
+def _is_hex(value: str) -> bool:
+    try:
+        int(value, 16)
+        return True
+    except ValueError:
+        return False
+
+
+class SpanAwareLevelFilter(logging.Filter):
+    """ログレベルによるフィルタ（スパンログは常に通過させる）"""
+    
+    def __init__(self, level: int):
+        super().__init__()
+        self.level = level
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= self.level or record.name == SPAN_LOGGER_NAME
 
 
 class DevFormatter(logging.Formatter):
@@ -94,8 +407,13 @@ class JSONFormatter(logging.Formatter):
         self.environment = environment
     
     def format(self, record: logging.LogRecord) -> str:
+        log_entry = {'timestamp': datetime.utcnow().isoformat() + 'Z'}
+        log_entry.update(self.log_fields(record))
+        return json.dumps(log_entry, ensure_ascii=False)
+    
+    def log_fields(self, record: logging.LogRecord) -> Dict[str, Any]:
+        """タイムスタンプ以外のログフィールドを出力順で取得"""
         log_entry = {
-            'timestamp': datetime.utcnow().isoformat() + 'Z',
             'level': record.levelname,
             'service': self.service_name,
             'environment': self.environment,
@@ -113,7 +431,17 @@ class JSONFormatter(logging.Formatter):
         if hasattr(record, 'request_id'):
             log_entry['request_id'] = record.request_id
         
-        return json.dumps(log_entry, ensure_ascii=False)
+        # スパン情報（スパン終了ログ、またはスパン内で出力されたログ）
+        span_fields = getattr(record, 'span', None)
+        if span_fields:
+            log_entry.update(span_fields)
+        else:
+            current = _current_span.get()
+            if current is not None and current.sampled:
+                log_entry['trace_id'] = current.trace_id
+                log_entry['span_id'] = current.span_id
+        
+        return log_entry
 
 
 class LoggingError(Exception):
@@ -0,0 +1,343 @@
+"""
+コンパクトログテスト
+
+コンパクトエンコーディングとJSONFormatter出力のラウンドトリップのテスト
+"""
+
+import io
+import json
+import logging
+import sys
+import threading
+import time
+from datetime import datetime
+
+import pytest
+
+from healthmate_core.environment import JSONFormatter, LogController, LoggingError
+from healthmate_core.environment.compact_log import (
+    CompactLogDecoder,
+    CompactLogEncoder,
+    CompactLogHandler,
+    decode_compact_log,
+)
+
+
+SERVICE = "test-service"
+ENVIRONMENT = "prod"
+
+
+def make_record(message="hello", level=logging.WARNING, name="app", args=(), exc_info=None, **extra):
+    record = logging.LogRecord(name, level, __file__, 1, message, args, exc_info)
+    for key, value in extra.items():
+        setattr(record, key, value)
+    return record
+
+
+def sample_records():
+    try:
+        raise ValueError("失敗しました")
+    except ValueError:
+        exc_info = sys.exc_info()
+    return [
+        make_record("plain"),
+        make_record("héllo \"quoted\"\n日本語 🎉", name="app.日本"),
+        make_record("failed %s", logging.ERROR, args=("job",), exc_info=exc_info),
+        make_record("ids", user_id=42, request_id="req-1"),
+        make_record("big", user_id=-(2 ** 70), request_id=None),
+        make_record("float", user_id=1.0 / 3, request_id=float("nan")),
+        make_record("inf", user_id=float("-inf"), request_id=True),
+        make_record("dict", request_id={"a": [1, 2.5, None, "ü"]}),
+        make_record("span finished", name="healthmate.span", span={
+            'span_name': "handler", 'trace_id': "4bf92f3577b34da6a3ce929d0e0e4736",
+            'span_id': "00f067aa0ba902b7", 'parent_id': None, 'duration_ms': 1.25,
+            'error': "ValueError",
+        }),
+    ]
+
+
+def encode_records(records, compress=False, block_size=4096):
+    """ハンドラーでエンコードし、JSONFormatterの出力と共に返す"""
+    stream = io.BytesIO()
+    handler = CompactLogHandler(stream, SERVICE, ENVIRONMENT, compress=compress, block_size=block_size)
+    formatter = JSONFormatter(SERVICE, ENVIRONMENT)
+    expected = []
+    for record in records:
+        handler.handle(record)
+        expected.append(formatter.format(record))
+    handler.close()
+    return stream.getvalue(), expected
+
+
+def assert_same_lines(decoded, expected):
+    """タイムスタンプ以外がバイト単位で一致し、タイムスタンプ書式も同一であること"""
+    assert len(decoded) == len(expected)
+    for got, want in zip(decoded, expected):
+        got_prefix, got_rest = got.split('", ', 1)
+        want_prefix, want_rest = want.split('", ', 1)
+        assert got_rest == want_rest
+        assert got_prefix.startswith('{"timestamp": "') and got_prefix.endswith('Z')
+
+
+def decode_all(data, chunk_size=None):
+    decoder = CompactLogDecoder()
+    lines = []
+    step = chunk_size or len(data) or 1
+    for i in range(0, len(data), step):
+        lines.extend(decoder.feed(data[i:i + step]))
+    lines.extend(decoder.close())
+    return lines
+
+
+# --- ラウンドトリップ ---
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_round_trip(compress):
+    records = sample_records()
+    data, expected = encode_records(records, compress=compress)
+    assert_same_lines(decode_all(data), expected)
+
+
+@pytest.mark.parametrize("compress", [False, True])
+@pytest.mark.parametrize("chunk_size", [1, 3, 17])
+def test_round_trip_small_chunks(compress, chunk_size):
+    records = sample_records() * 20
+    data, expected = encode_records(records, compress=compress, block_size=512)
+    assert_same_lines(decode_all(data, chunk_size), expected)
+    assert list(decode_compact_log(io.BytesIO(data), chunk_size)) == decode_all(data)
+
+
+def test_timestamp_is_byte_identical():
+    # マイクロ秒が0の場合のisoformat()も含めて同一であること
+    encoder = CompactLogEncoder()
+    decoder = CompactLogDecoder()
+    fields = JSONFormatter(SERVICE, ENVIRONMENT).log_fields(make_record())
+    decoder.feed(encoder.header())
+    for timestamp in [datetime(2026, 1, 1), datetime(2026, 1, 1, 0, 0, 0, 5), datetime(2025, 12, 31, 23, 59)]:
+        [line] = decoder.feed(encoder.encode(timestamp, fields))
+        want = {'timestamp': timestamp.isoformat() + 'Z'}
+        want.update(fields)
+        assert line == json.dumps(want, ensure_ascii=False)
+
+
+def test_compact_is_smaller_than_json():
+    records = [make_record("request %d done", args=(i,), request_id=f"req-{i}") for i in range(200)]
+    data, expected = encode_records(records)
+    assert len(data) * 2 < len("\n".join(expected).encode('utf-8'))
+
+
+# --- 追記されたストリーム ---
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_two_streams_appended_to_one_file(tmp_path, compress):
+    path = tmp_path / "app.hmlc"
+    formatter = JSONFormatter(SERVICE, ENVIRONMENT)
+    expected = []
+    for batch in (sample_records(), sample_records()[:3]):
+        handler = CompactLogHandler(open(path, 'ab'), SERVICE, ENVIRONMENT,
+                                    compress=compress, close_stream=True)
+        for record in batch:
+            handler.handle(record)
+            expected.append(formatter.format(record))
+        handler.close()
+
+    with open(path, 'rb') as stream:
+        assert_same_lines(list(decode_compact_log(stream, 5)), expected)
+
+
+def test_append_after_crashed_compressed_writer(tmp_path):
+    path = tmp_path / "app.hmlc"
+    formatter = JSONFormatter(SERVICE, ENVIRONMENT)
+
+    # 1つ目のライターはflushのみでcloseされない（プロセスが強制終了された想定）
+    crashed = open(path, 'ab')
+    crashed_handler = CompactLogHandler(crashed, SERVICE, ENVIRONMENT, compress=True, flush_interval=3600)
+    first = make_record("before crash")
+    crashed_handler.handle(first)
+    crashed_handler.flush()
+    lost = make_record("never flushed")
+    crashed_handler.handle(lost)
+    # 強制終了を模して、書き出されないままのブロックとタイマーを破棄する
+    crashed_handler._cancel_timer()
+    crashed.close()
+
+    handler = CompactLogHandler(open(path, 'ab'), SERVICE, ENVIRONMENT, compress=True, close_stream=True)
+    second = make_record("after restart")
+    handler.handle(second)
+    handler.close()
+
+    with open(path, 'rb') as stream:
+        decoded = list(decode_compact_log(stream))
+    assert_same_lines(decoded, [formatter.format(first), formatter.format(second)])
+
+
+@pytest.mark.parametrize("compress", [False, True])
+@pytest.mark.parametrize("cut", [1, 5, 11])
+def test_append_after_torn_frame(compress, cut):
+    # 1つ目のストリームはフレームの途中で途切れている（書き込み中に強制終了された想定）
+    first, first_expected = encode_records(sample_records(), compress=compress, block_size=64)
+    second, second_expected = encode_records(sample_records()[:3], compress=compress)
+    torn = first[:-cut]
+
+    for chunk_size in (None, 1, 7):
+        decoded = decode_all(torn + second, chunk_size)
+        assert_same_lines(decoded[-3:], second_expected)
+        # 途切れる前のレコードは復元される
+        assert_same_lines(decoded[:-3], first_expected[:len(decoded) - 3])
+        assert len(decoded) > 3
+
+
+# --- 圧縮ブロックの書き出し ---
+
+def test_error_record_flushes_block():
+    stream = io.BytesIO()
+    handler = CompactLogHandler(stream, SERVICE, ENVIRONMENT, compress=True, flush_interval=60)
+    handler.handle(make_record("info", logging.INFO))
+    assert decode_all(stream.getvalue()) == []
+    handler.handle(make_record("error", logging.ERROR))
+    assert [json.loads(line)['message'] for line in decode_all(stream.getvalue())] == ["info", "error"]
+    handler.close()
+
+
+def test_block_flushed_after_interval():
+    stream = io.BytesIO()
+    handler = CompactLogHandler(stream, SERVICE, ENVIRONMENT, compress=True, flush_interval=0.05)
+    handler.handle(make_record("info", logging.INFO))
+    deadline = time.time() + 5
+    while not decode_all(stream.getvalue()) and time.time() < deadline:
+        time.sleep(0.01)
+    assert [json.loads(line)['message'] for line in decode_all(stream.getvalue())] == ["info"]
+    handler.close()
+
+
+def test_broken_stream_while_block_pending():
+    errors = []
+    thread_errors = []
+
+    class RecordingHandler(CompactLogHandler):
+        def handleError(self, record):
+            errors.append((record, sys.exc_info()[0]))
+
+    original_excepthook = threading.excepthook
+    threading.excepthook = thread_errors.append
+    try:
+        stream = io.BytesIO()
+        handler = RecordingHandler(stream, SERVICE, ENVIRONMENT, compress=True, flush_interval=0.05)
+        pending = make_record("pending", logging.INFO)
+        handler.handle(pending)
+        stream.close()
+
+        deadline = time.time() + 5
+        while not errors and time.time() < deadline:
+            time.sleep(0.01)
+
+        # タイマーでの書き出し失敗はhandleErrorで1度だけ報告され、以降は出力を停止する
+        assert errors == [(pending, ValueError)]
+        assert handler.broken
+        handler.handle(make_record("after", logging.ERROR))
+        handler.flush()
+        handler.close()
+        assert len(errors) == 1
+        assert thread_errors == []
+    finally:
+        threading.excepthook = original_excepthook
+
+
+def test_span_names_are_not_interned():
+    records = [make_record("span", span={'span_name': f"span-{i}"}) for i in range(50)]
+    data, expected = encode_records(records)
+    assert_same_lines(decode_all(data), expected)
+    # 任意のスパン名で文字列辞書が増え続けないこと
+    encoder = CompactLogEncoder()
+    fields = JSONFormatter(SERVICE, ENVIRONMENT).log_fields(records[0])
+    for i in range(50):
+        fields['span_name'] = f"span-{i}"
+        encoder.encode(datetime(2026, 1, 1), fields)
+    assert len(encoder._string_refs) == len(fields) + 4
+
+
+# --- 不正な入力 ---
+
+def test_truncated_input():
+    data, _ = encode_records(sample_records())
+    decoder = CompactLogDecoder()
+    decoder.feed(data[:-3])
+    with pytest.raises(LoggingError):
+        decoder.close()
+
+
+def test_missing_header():
+    data, _ = encode_records(sample_records())
+    with pytest.raises(LoggingError):
+        decode_all(data[8:])
+
+
+def test_unsupported_version():
+    data, _ = encode_records([make_record()])
+    corrupted = bytearray(data)
+    corrupted[6] = 99
+    with pytest.raises(LoggingError):
+        decode_all(bytes(corrupted))
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_corrupted_bytes_raise_logging_error(compress):
+    data, _ = encode_records(sample_records(), compress=compress)
+    # ヘッダー以降の各バイトを破損させても、LoggingError以外の例外は発生しない
+    for i in range(8, len(data)):
+        for value in (0x00, 0xFF):
+            corrupted = bytearray(data)
+            corrupted[i] = value
+            try:
+                decode_all(bytes(corrupted))
+            except LoggingError:
+                pass
+
+
+def test_corrupted_record_payload():
+    decoder = CompactLogDecoder()
+    decoder.feed(CompactLogEncoder().header())
+    # フィールド数が1だがキーが存在しないレコード（次のヘッダーを探索し、終端でエラー）
+    assert decoder.feed(bytes((0x02, 0x02, 0x00, 0x01))) == []
+    with pytest.raises(LoggingError):
+        decoder.close()
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_resync_after_corrupted_stream(compress):
+    first, _ = encode_records(sample_records(), compress=compress)
+    second, expected = encode_records(sample_records()[:3], compress=compress)
+    corrupted = bytearray(first)
+    corrupted[len(first) // 2] ^= 0xFF
+    decoder = CompactLogDecoder()
+    lines = decoder.feed(bytes(corrupted) + second)
+    lines.extend(decoder.close())
+    assert_same_lines(lines[-3:], expected)
+    assert decoder.skipped_bytes > 0
+
+
+# --- LogController連携 ---
+
+def test_add_sink_compact_file(tmp_path, monkeypatch):
+    monkeypatch.setenv("HEALTHMATE_ENV", "prod")
+    path = tmp_path / "app.hmlc"
+    controller = LogController(SERVICE, span_sample_rate=1.0)
+    handler = controller.add_sink(str(path), encoding="compact", compress=True)
+    try:
+        logging.getLogger("app").warning("via sink")
+        with controller.span("handler"):
+            pass
+    finally:
+        logging.getLogger().removeHandler(handler)
+        handler.close()
+
+    with open(path, 'rb') as stream:
+        entries = [json.loads(line) for line in decode_compact_log(stream)]
+    assert [entry['message'] for entry in entries][0] == "via sink"
+    assert entries[-1]['span_name'] == "handler"
+
+
+def test_add_sink_rejects_unknown_encoding():
+    controller = LogController(SERVICE)
+    with pytest.raises(LoggingError):
+        controller.add_sink(io.BytesIO(), encoding="xml")
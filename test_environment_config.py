@@ -55,6 +55,11 @@ def test_environment_config():
         logger.info("これはINFOログです")
         logger.warning("これはWARNINGログです")
         logger.error("これはERRORログです")
+        
+        # スパンのテスト
+        with log_controller.span("test-span") as span:
+            logger.info("これはスパン内のINFOログです")
+            print(f"traceparent: {span.traceparent()}")
     else:
         print("Log Controller の初期化に失敗しました")
     
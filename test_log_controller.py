@@ -0,0 +1,216 @@
+"""
+ログ制御テスト
+
+LogControllerのスパン計測とトレースヘッダー解析のテスト
+"""
+
+import asyncio
+import logging
+import time
+
+import pytest
+
+from healthmate_core.environment import LogController, LoggingError, Span, TraceContext, parse_trace_header
+from healthmate_core.environment.log_controller import SPAN_LOGGER_NAME
+
+
+TRACEPARENT_SAMPLED = "00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01"
+TRACEPARENT_UNSAMPLED = "00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-00"
+XRAY_HEADER = "Root=1-5759e988-bd862e3fe1be46a994272793;Parent=53995c3f42cd8ad8;Sampled=1"
+
+
+class ListHandler(logging.Handler):
+    """出力されたログレコードを保持するハンドラー"""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+@pytest.fixture
+def make_controller(monkeypatch):
+    """スパンログを捕捉するLogControllerの生成"""
+    monkeypatch.delenv("HEALTHMATE_SPAN_SAMPLE_RATE", raising=False)
+    handler = ListHandler()
+    span_logger = logging.getLogger(SPAN_LOGGER_NAME)
+    span_logger.addHandler(handler)
+
+    def factory(**kwargs):
+        controller = LogController("test-service", **kwargs)
+        return controller, handler.records
+
+    yield factory
+    span_logger.removeHandler(handler)
+
+
+# --- parse_trace_header ---
+
+def test_parse_traceparent():
+    context = parse_trace_header(TRACEPARENT_SAMPLED)
+    assert context == TraceContext("4bf92f3577b34da6a3ce929d0e0e4736", "00f067aa0ba902b7", True)
+    assert parse_trace_header(TRACEPARENT_UNSAMPLED).sampled is False
+
+
+def test_parse_xray_header():
+    context = parse_trace_header(XRAY_HEADER)
+    assert context == TraceContext("5759e988bd862e3fe1be46a994272793", "53995c3f42cd8ad8", True)
+
+
+def test_parse_xray_header_without_sampling_decision():
+    context = parse_trace_header("Root=1-5759e988-bd862e3fe1be46a994272793")
+    assert context == TraceContext("5759e988bd862e3fe1be46a994272793", None, None)
+
+
+@pytest.mark.parametrize("header", [
+    "",
+    "garbage",
+    "00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7",
+    "ff-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01",
+    "00-00000000000000000000000000000000-00f067aa0ba902b7-01",
+    "00-4bf92f3577b34da6a3ce929d0e0e4736-0000000000000000-01",
+    "00-4bf92f3577b34da6a3ce929d0e0e473z-00f067aa0ba902b7-01",
+    "00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-0g",
+    "Root=2-5759e988-bd862e3fe1be46a994272793",
+    "Root=1-5759e988-bd862e3f",
+    "Root=1-5759e988-bd862e3fe1be46a994272793;Parent=xyz",
+])
+def test_parse_invalid_header(header):
+    assert parse_trace_header(header) is None
+
+
+# --- スパン ---
+
+def test_nested_spans_share_trace(make_controller):
+    controller, records = make_controller(span_sample_rate=1.0)
+    with controller.span("outer") as outer:
+        assert LogController.current_span() is outer
+        with controller.span("inner") as inner:
+            assert LogController.current_span() is inner
+        assert LogController.current_span() is outer
+    assert LogController.current_span() is None
+
+    assert inner.trace_id == outer.trace_id
+    assert inner.parent_id == outer.span_id
+    assert outer.parent_id is None
+    assert [record.span['span_name'] for record in records] == ["inner", "outer"]
+    assert all(record.span['duration_ms'] >= 0 for record in records)
+
+
+def test_span_records_error(make_controller):
+    controller, records = make_controller(span_sample_rate=1.0)
+    with pytest.raises(ValueError):
+        with controller.span("failing"):
+            raise ValueError("boom")
+    assert records[0].span['error'] == "ValueError"
+    assert LogController.current_span() is None
+
+
+def test_new_trace_id_starts_with_epoch_seconds(make_controller):
+    controller, _ = make_controller(span_sample_rate=1.0)
+    with controller.span("root") as span:
+        pass
+    assert abs(int(span.trace_id[:8], 16) - time.time()) < 60
+    root = span.xray_header().split(";")[0]
+    assert root == f"Root=1-{span.trace_id[:8]}-{span.trace_id[8:]}"
+    assert parse_trace_header(span.xray_header()).trace_id == span.trace_id
+
+
+def test_unsampled_root_propagates_to_children(make_controller, monkeypatch):
+    controller, records = make_controller(span_sample_rate=0.5)
+    monkeypatch.setattr("random.random", lambda: 0.9)
+    with controller.span("root") as root:
+        assert root.sampled is False
+        # 子スパンではサンプリングを再判定しない
+        monkeypatch.setattr("random.random", lambda: 0.0)
+        with controller.span("child") as child:
+            assert child.sampled is False
+            assert LogController.current_span() is root
+    assert records == []
+
+
+def test_sampled_header_is_parent(make_controller):
+    controller, records = make_controller(span_sample_rate=0.5)
+    with controller.span("handler", trace_header=TRACEPARENT_SAMPLED) as span:
+        assert span.sampled is True
+        assert span.trace_id == "4bf92f3577b34da6a3ce929d0e0e4736"
+        assert span.parent_id == "00f067aa0ba902b7"
+        assert span.traceparent() == f"00-{span.trace_id}-{span.span_id}-01"
+    assert len(records) == 1
+
+
+def test_unsampled_header_keeps_trace_for_propagation(make_controller):
+    controller, records = make_controller(span_sample_rate=1.0)
+    with controller.span("handler", trace_header=TRACEPARENT_UNSAMPLED) as span:
+        assert span.sampled is False
+        assert span.traceparent() == TRACEPARENT_UNSAMPLED
+        with controller.span("child") as child:
+            assert child.sampled is False
+    assert records == []
+
+
+def test_invalid_header_falls_back_to_current_span(make_controller):
+    controller, _ = make_controller(span_sample_rate=1.0)
+    with controller.span("outer") as outer:
+        with controller.span("inner", trace_header="garbage") as inner:
+            assert inner.trace_id == outer.trace_id
+            assert inner.parent_id == outer.span_id
+
+
+def test_zero_sample_rate_disables_spans(make_controller, monkeypatch):
+    monkeypatch.setenv("HEALTHMATE_SPAN_SAMPLE_RATE", "0")
+    controller, records = make_controller()
+    with controller.span("handler", trace_header=TRACEPARENT_SAMPLED) as span:
+        assert span.sampled is False
+        assert LogController.current_span() is None
+    assert records == []
+
+
+@pytest.mark.parametrize("rate", ["-0.1", "1.5", "abc"])
+def test_invalid_sample_rate(monkeypatch, rate):
+    monkeypatch.setenv("HEALTHMATE_SPAN_SAMPLE_RATE", rate)
+    with pytest.raises(LoggingError):
+        LogController("test-service")
+
+
+# --- traced デコレータ ---
+
+def test_traced_sync_function(make_controller):
+    controller, records = make_controller(span_sample_rate=1.0)
+
+    @controller.traced()
+    def add(a, b):
+        assert isinstance(LogController.current_span(), Span)
+        return a + b
+
+    assert add(1, 2) == 3
+    assert add.__name__ == "add"
+    assert records[0].span['span_name'] == add.__qualname__
+
+
+def test_traced_async_function(make_controller):
+    controller, records = make_controller(span_sample_rate=1.0)
+
+    @controller.traced("fetch")
+    async def fetch():
+        await asyncio.sleep(0)
+        return LogController.current_span().name
+
+    assert asyncio.run(fetch()) == "fetch"
+    assert records[0].span['span_name'] == "fetch"
+
+
+def test_traced_rejects_generator_functions(make_controller):
+    controller, _ = make_controller(span_sample_rate=1.0)
+
+    def numbers():
+        yield 1
+
+    async def async_numbers():
+        yield 1
+
+    for func in (numbers, async_numbers):
+        with pytest.raises(LoggingError):
+            controller.traced()(func)